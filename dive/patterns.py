@@ -11,6 +11,11 @@ Unify takes 3 Arguments:
     that caused the failure and the second being the value that did not
     match that sub-pattern.
 
+pattern.matches(the_object) tells whether the object matches at all.
+pattern.solutions(the_object) matches without any continuations. It returns
+a list with one dict per match, mapping the variables of the pattern onto
+the values they were bound to in that match.
+
 Patterns can be combined using one of the following operations:
 
     a & b   matches a and b. b is not evaluated if a fails.
@@ -30,10 +35,16 @@ Available patterns are:
 
     Subtype(class_or_type):
         Matches the type of an object. Passes the object to the next pattern.
+        Checks against abstract base classes are remembered per type.
 
     Constant(value):
         Matches exactly the given value using ==. Not composable via **.
 
+    OneOf(values):
+        Matches any of the given hashable values using ==. Alternatives of
+        Constants of plain types (Constant(1) | Constant(2)) are matched
+        this way.
+
     Variable():
         First, matches any value and stores the matched object.
         If it is matched again, it matches against the stored object.
@@ -78,9 +89,11 @@ Available patterns are:
         does not fail if nothing matched. This may call neither
         a success nor a failure continuation.
 
-    All:
+    All():
         Matches all elements of a collection. Fails if any single element fails.
-        Passes the elements to the next (**) pattern.
+        Passes the elements to the next (**) pattern and proceeds once
+        after all of them matched. Variables bound while matching an
+        element are unbound again before proceeding.
 
     Get(lambda x: ... ):
         Retrieve the value computed by the given function and pass it on.
@@ -88,10 +101,17 @@ Available patterns are:
 
         Example: Attribute('foo') is just syntactic sugar for Get(lambda x: x.foo).
 
+        Get.attrchain('foo.bar') looks up x.foo.bar without a Python
+        function call, like Attribute('foo.bar').
+
     If(lambda x: ...):
         Checks the predicate on the given object. Proceeds with this value
         if the predicate evaluates to True. Fails otherwise.
 
+        If.lt(3), If.le(3), If.gt(3), If.ge(3), If.eq(3), If.ne(3) and
+        If.in_(collection) compare using the operator module instead of a
+        Python function call. If.lt(3) is equivalent to If(lambda x: x < 3).
+
         Example:
             var = Variable()
             pattern = Each ** If(lambda x: x < 3) ** var
@@ -99,18 +119,154 @@ Available patterns are:
 
             will call cont twice with var.value being 1 and 2.
 
+Compilation:
 
-"""
+    pattern.compile() walks the pattern once and generates a single Python
+    function performing the whole match. Tests, attribute lookups and
+    conjunctions are inlined instead of being dispatched through nested
+    unify() calls and continuation lambdas. The result is cached on the
+    pattern and can be used like any other pattern:
+
+        matcher = pattern.compile()
+        for obj in objects:
+            matcher.unify(obj, cont, fail)
+
+    The generated code is available as matcher.source.
+
+    pattern.specialize() compiles the pattern separately for each type of
+    value it is matched against. Type checks of the matched value itself
+    (Subtype) are then decided once while generating the code instead of
+    on every match.
+
+    pattern.flatten() translates the pattern into a flat list of
+    instructions instead, which is executed by a single loop. Its stack
+    depth does not grow with the size of the pattern.
+
+Pattern sets:
 
+    A PatternSet matches many patterns against the same value. Patterns
+    starting with the same test or lookup share it:
 
+        patterns = PatternSet()
+        patterns.add(Subtype(Mock) ** Attribute('foo') ** Constant(1), 'one')
+        patterns.add(Subtype(Mock) ** Attribute('foo') ** Constant(2), 'two')
+        patterns.match_all(Mock(2))     # ['two']
 
-def fail_silent(*_):
+    The type check and the lookup of foo happen once for both patterns.
+
+Memoization:
+
+    pattern.memoize() returns a pattern which remembers the values
+    extracted by Get, Attribute and Index and the results of If for the
+    duration of each match, so that alternatives (|) testing the same
+    objects again do not repeat that work. Sub-patterns without variables
+    are not even walked again: the outcome of matching them against an
+    object is remembered as well. The matched objects must not change
+    while being matched.
+
+"""
+
+import itertools
+import keyword
+import operator
+import re
+import threading
+import weakref
+from abc import ABCMeta
+from array import array
+from contextlib import contextmanager
+from functools import partial
+
+__all__ = [
+    'fail_silent', 'Unifiable', 'PatternMonad',
+    'Anything', 'Return', 'Nothing', 'Fail', 'Variable', 'Constant',
+    'Match', 'Ensure', 'OneOf', 'And', 'Or', 'MatchAny', 'MatchAll',
+    'Attribute', 'Subtype', 'Index', 'Get', 'If',
+    'Any', 'Some', 'First', 'Each', 'All',
+    'PatternSet', 'Memoized', 'Compiled', 'Specialized', 'Program',
+]
+
+try:
+    from itertools import ifilter as _filter
+except ImportError:
+    _filter = filter
+
+try:
+    from sys import intern as _intern
+except ImportError:
+    _intern = intern
+
+try:
+    from abc import get_cache_token as _abc_token
+except ImportError:
+    def _abc_token():
+        # Changes whenever a class is registered with an ABC
+        return ABCMeta._abc_invalidation_counter
+
+
+def fail_silent(pattern=None, value=None):
+    # Fixed arguments, this is called for every element skipped by Any
     pass
 
 
+class _Found(Exception):
+    """Ends a match at its first solution, see Unifiable.matches()"""
+
+
+def _stop_at_first():
+    raise _Found()
+
+
+#
+#   Variables currently bound, in the order of binding.
+#
+#   An alternative of | must not see the bindings made while its
+#   predecessor failed. Or records the height of the trail and unbinds
+#   everything above it before trying the alternative. The bindings are
+#   restored afterwards, as the failed branch unbinds them on its own
+#   when it returns.
+#
+#   Each thread has a trail of its own, so that it only ever unbinds the
+#   variables it bound itself. The bindings are still visible to other
+#   threads, as they are stored on the shared Variable objects.
+#
+
+class _State(threading.local):
+    """Matching state of the current thread"""
+
+    def __init__(self):
+        self.trail = []
+
+_STATE = _State()
+
+
+def _unwind(mark):
+    """Unbind variables bound after mark, return them for _rewind()"""
+    trail = _STATE.trail
+    if mark == len(trail):
+        return ()
+    undone = [(var, var.value) for var in trail[mark:]]
+    del trail[mark:]
+    for var, _ in undone:
+        var.bound = False
+        var.value = None
+    return undone
+
+
+def _rewind(undone):
+    """Restore bindings removed by _unwind()"""
+    trail = _STATE.trail
+    for var, value in undone:
+        var.bound = True
+        var.value = value
+        trail.append(var)
+
+
 class Unifiable(object):
     """Base class for continuation-passing matchers"""
 
+    __slots__ = ('_compiled', '_specialized')
+
     def unify(self, value, cont, fail=fail_silent):
         raise NotImplemented
 
@@ -125,23 +281,148 @@ class Unifiable(object):
     def __and__(self, other):
         return And(self, other)
 
+    def _head(self):
+        # (key, rest, rebuild) if the pattern starts with a deterministic
+        # test identified by key and continues with the pattern rest.
+        # rebuild(other) creates the same test continuing with other.
+        return None
+
+    def _parts(self):
+        # Sub-patterns this pattern delegates to
+        return ()
+
+    def matches(self, value):
+        """Whether value matches this pattern at least once"""
+        # Variables and alternatives unbind while the exception passes
+        try:
+            self.unify(value, _stop_at_first)
+        except _Found:
+            return True
+        return False
+
+    def solutions(self, value):
+        """Bindings of the variables in this pattern for each match"""
+        variables = [part for part in _walk(self) if isinstance(part, Variable)]
+        found = []
+        self.unify(value, lambda: found.append(
+            dict((var, var.value) for var in variables if var.bound)))
+        return found
+
+    def memoize(self):
+        """Return an equivalent pattern remembering extracted values
+        during a match, if it has alternatives which could reuse them"""
+        if any(isinstance(part, Or) for part in _walk(self)):
+            return Memoized(self)
+        return self
+
+    def _unify_memo(self, value, cont, fail, memo):
+        # Like unify(), remembering what is extracted or tested in memo.
+        # Only used within Memoized, nothing to remember by default.
+        self.unify(value, cont, fail)
+
+    def compile(self):
+        """Return an equivalent pattern running as generated Python code"""
+        compiled = getattr(self, '_compiled', None)
+        if compiled is None:
+            compiled = self._compiled = Compiled(self)
+        return compiled
+
+    #
+    #   Code generation.
+    #
+    #   _compile() emits statements equivalent to unify() into a _Source.
+    #   Instead of callables, it receives emitters for the success and
+    #   failure continuations which are inlined where possible.
+    #   _sites() counts how often these emitters would be inlined, so that
+    #   _emit() can wrap them into a local function instead of duplicating
+    #   their code.
+    #
+
+    def _sites(self):
+        return 1, 1
+
+    def _emit(self, ctx, value, cont, fail):
+        conts, fails = self._sites()
+        if conts > 1:
+            cont = ctx.share_cont(cont)
+        if fails > 1:
+            fail = ctx.share_fail(fail)
+        self._compile(ctx, value, cont, fail)
+
+    def _compile(self, ctx, value, cont, fail):
+        # No specialized code available, call the interpreter
+        ctx.emit('%s.unify(%s, %s, %s)' % (
+            ctx.ref(self), value,
+            ctx.share_cont(cont).name, ctx.share_fail(fail).name))
+
+    def specialize(self):
+        """Return an equivalent pattern compiled once per type of value"""
+        specialized = getattr(self, '_specialized', None)
+        if specialized is None:
+            specialized = self._specialized = Specialized(self)
+        return specialized
+
+    def flatten(self):
+        """Return an equivalent pattern running on the instruction loop"""
+        return Program(self)
+
+    def _flatten(self, ops, value, fail):
+        # Appends instructions matching the value in the given slot.
+        # Success falls through to the next instruction,
+        # failure jumps to the instruction at fail.
+        ops.emit(OP_UNIFY, self, value, fail=fail)
+
 
 class PatternMonad(Unifiable):
     """Base class for chainable patterns"""
 
+    __slots__ = ()
+
     def __pow__(self, other):
         return self.bind(other)
 
     def unify(self, value, cont, fail=fail_silent):
         self.bind(Return).unify(value, cont, fail)
 
+    def _unify_memo(self, value, cont, fail, memo):
+        self.bind(Return)._unify_memo(value, cont, fail, memo)
+
+    def _parts(self):
+        return self.bind(Return),
+
+    def _sites(self):
+        return self.bind(Return)._sites()
+
+    def _compile(self, ctx, value, cont, fail):
+        self.bind(Return)._compile(ctx, value, cont, fail)
+
+    def _flatten(self, ops, value, fail):
+        self.bind(Return)._flatten(ops, value, fail)
+
 
 class Anything(Unifiable):
     """Consumes a value and succeeds"""
 
+    __slots__ = ()
+
+    def __new__(cls):
+        # Stateless, so all instances are Return
+        if '_instance' not in cls.__dict__:
+            cls._instance = Unifiable.__new__(cls)
+        return cls._instance
+
     def unify(self, value, cont, fail=fail_silent):
         cont()
 
+    def _sites(self):
+        return 1, 0
+
+    def _compile(self, ctx, value, cont, fail):
+        cont(ctx)
+
+    def _flatten(self, ops, value, fail):
+        pass
+
     def __repr__(self):
         return "<Anything>"
 Return = Anything()
@@ -150,9 +431,26 @@ Return = Anything()
 class Nothing(Unifiable):
     """Consumes a value and fails"""
 
+    __slots__ = ()
+
+    def __new__(cls):
+        # Stateless, so all instances are Fail
+        if '_instance' not in cls.__dict__:
+            cls._instance = Unifiable.__new__(cls)
+        return cls._instance
+
     def unify(self, value, cont, fail=fail_silent):
         fail(self, value)
 
+    def _sites(self):
+        return 0, 1
+
+    def _compile(self, ctx, value, cont, fail):
+        fail(ctx, ctx.ref(self), value)
+
+    def _flatten(self, ops, value, fail):
+        ops.emit(OP_FAIL, None, value, node=self, fail=fail)
+
     def __repr__(self):
         return "<Nothing>"
 Fail = Nothing()
@@ -161,17 +459,21 @@ Fail = Nothing()
 class Variable(PatternMonad):
     """Binds to the value matched. Only matches the bound value again. Passes matching results to next pattern."""
 
-    _max_id = 0
+    __slots__ = ('id', 'bound', 'value')
+
+    _next_id = itertools.count()
 
     def __init__(self):
-        self.id = Variable._max_id
-        Variable._max_id += 1
+        self.id = next(Variable._next_id)
         self.bound = False
         self.value = None
 
     def bind(self, bind):
         return And(self, bind)
 
+    def _parts(self):
+        return ()
+
     def bind_to(self, value):
         self.bound = True
         self.value = value
@@ -187,9 +489,47 @@ class Variable(PatternMonad):
             else:
                 fail(self, value)
         else:
-            self.bind_to(value)
-            cont()
-            self.unbind()       # backtrack after continuation returned
+            # bind_to() and unbind() inlined, this is the innermost step
+            self.bound = True
+            self.value = value
+            trail = _STATE.trail
+            trail.append(self)
+            try:
+                cont()
+            finally:
+                trail.pop()         # backtrack after continuation returned
+                self.bound = False
+                self.value = None
+
+    def _unify_memo(self, value, cont, fail, memo):
+        self.unify(value, cont, fail)
+
+    def _sites(self):
+        return 1, 1
+
+    def _compile(self, ctx, value, cont, fail):
+        var = ctx.ref(self)
+        bound = ctx.fresh('_b')
+        ctx.emit('%s = %s.bound' % (bound, var))
+        ctx.emit('if %s and not %s == %s.value:' % (bound, value, var))
+        with ctx.indented():
+            fail(ctx, var, value)
+        ctx.emit('else:')
+        with ctx.indented():
+            ctx.emit('if not %s:' % bound)
+            with ctx.indented():
+                ctx.emit('%s.bound = True' % var)
+                ctx.emit('%s.value = %s' % (var, value))
+                ctx.emit('%s.trail.append(%s)' % (ctx.ref(_STATE), var))
+            cont(ctx)
+            ctx.emit('if not %s:' % bound)
+            with ctx.indented():
+                ctx.emit('%s.trail.pop()' % ctx.ref(_STATE))
+                ctx.emit('%s.bound = False' % var)
+                ctx.emit('%s.value = None' % var)
+
+    def _flatten(self, ops, value, fail):
+        ops.emit(OP_VAR, self, value, node=self, fail=fail)
 
     def __repr__(self):
         if self.bound:
@@ -201,15 +541,50 @@ class Variable(PatternMonad):
 class Constant(Unifiable):
     """Only matches a specific value"""
 
-    def __init__(self, value):
-        self.value = value
+    __slots__ = ('value', '__weakref__')
+
+    # Constants of plain values are shared. Containers are not, as equal
+    # ones may still hold elements of different types ((1,) and (True,)).
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, value):
+        if type(value) not in _PLAIN:
+            constant = Unifiable.__new__(cls)
+            constant.value = value
+            return constant
+        key = (cls, type(value), value)
+        constant = cls._interned.get(key)
+        if constant is None:
+            constant = Unifiable.__new__(cls)
+            constant.value = value
+            cls._interned[key] = constant
+        return constant
 
     def unify(self, value, cont, fail=fail_silent):
-        if value == self.value:
+        if value is self.value or value == self.value:
             cont()
         else:
             fail(self, value)
 
+    def _sites(self):
+        return 1, 1
+
+    def _compile(self, ctx, value, cont, fail):
+        constant = ctx.ref(self.value)
+        ctx.emit('if %s is %s or %s == %s:' % (value, constant, value, constant))
+        with ctx.indented():
+            cont(ctx)
+        ctx.emit('else:')
+        with ctx.indented():
+            fail(ctx, ctx.ref(self), value)
+
+    def _flatten(self, ops, value, fail):
+        ops.emit(OP_EQ, self.value, value, node=self, fail=fail)
+
+    def _head(self):
+        return (('eq', type(self.value), self.value), Return,
+                lambda rest: And(self, rest))
+
     def __repr__(self):
         return "<Constant %s>" % self.value
 
@@ -217,38 +592,197 @@ class Constant(Unifiable):
 class Match(Unifiable):
     """Evaluates an expression and continues to match its value"""
 
+    __slots__ = ('match', 'into')
+
     def __init__(self, match, into):
         self.into = into
         self.match = match
 
     def unify(self, value, cont, fail=fail_silent):
         try:
-            self.into.unify(self.match(value), cont, fail)
+            matched = self.match(value)
         except (IndexError, KeyError, AttributeError):
             fail(self, value)
+            return
+        self.into.unify(matched, cont, fail)
+
+    def _unify_memo(self, value, cont, fail, memo):
+        if id(self) in memo.replayed and _replay(memo, self, value, cont, fail):
+            return
+        matched = _remember(memo, self.match, value, True)
+        if matched is _FAILED:
+            fail(self, value)
+            return
+        self.into._unify_memo(matched, cont, fail, memo)
+
+    def _parts(self):
+        return self.into,
+
+    def _sites(self):
+        conts, fails = self.into._sites()
+        return conts, fails + 1
+
+    def _compile(self, ctx, value, cont, fail):
+        matched = ctx.fresh('_v')
+        ctx.emit('try:')
+        with ctx.indented():
+            ctx.emit('%s = %s' % (matched, self._extract(ctx, value)))
+        ctx.emit('except (IndexError, KeyError, AttributeError):')
+        with ctx.indented():
+            fail(ctx, ctx.ref(self), value)
+        ctx.emit('else:')
+        with ctx.indented():
+            self.into._emit(ctx, matched, cont, fail)
+
+    def _extract(self, ctx, value):
+        return '%s(%s)' % (ctx.ref(self.match), value)
+
+    def _flatten(self, ops, value, fail):
+        # Chains of lookups and tests are walked iteratively
+        pattern = self
+        while isinstance(pattern, Match):
+            value = pattern._step(ops, value, fail)
+            pattern = pattern.into
+        pattern._flatten(ops, value, fail)
+
+    def _step(self, ops, value, fail):
+        matched = ops.slot()
+        ops.emit(OP_CALL, self.match, value, matched, self, fail)
+        return matched
+
+    def _head(self):
+        return ('get', self.match), self.into, lambda rest: Match(self.match, rest)
 
 
 class Ensure(Match):
     """Evaluate an expression and continue if true"""
 
+    __slots__ = ()
+
     def unify(self, value, cont, fail=fail_silent):
         if self.match(value):
-            cont()
+            self.into.unify(value, cont, fail)
         else:
             fail(self, value)
 
+    def _unify_memo(self, value, cont, fail, memo):
+        if id(self) in memo.replayed and _replay(memo, self, value, cont, fail):
+            return
+        if _remember(memo, self.match, value, False):
+            self.into._unify_memo(value, cont, fail, memo)
+        else:
+            fail(self, value)
+
+    def _compile(self, ctx, value, cont, fail):
+        ctx.emit('if %s:' % self._test(ctx, value))
+        with ctx.indented():
+            self.into._emit(ctx, value, cont, fail)
+        ctx.emit('else:')
+        with ctx.indented():
+            fail(ctx, ctx.ref(self), value)
+
+    def _test(self, ctx, value):
+        return '%s(%s)' % (ctx.ref(self.match), value)
+
+    def _step(self, ops, value, fail):
+        ops.emit(OP_TEST, self.match, value, node=self, fail=fail)
+        return value
+
+    def _head(self):
+        return ('if', self.match), self.into, lambda rest: Ensure(self.match, rest)
+
+
+class OneOf(Ensure):
+    """Matches any of the given hashable values"""
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        Ensure.__init__(self, self._contains, Return)
+        self.values = frozenset(values)
+
+    def _contains(self, value):
+        try:
+            if value in self.values:
+                return True
+        except TypeError:       # unhashable values are compared one by one
+            pass
+        else:
+            if type(value) in _PLAIN:
+                return False
+        # Values of other types may be equal without having the same hash
+        return any(value == other for other in self.values)
+
+    def __repr__(self):
+        return "<OneOf %s>" % ', '.join(sorted(map(repr, self.values)))
+
 
 class And(Unifiable):
     """Matches first argument. On success, matches second argument"""
 
+    __slots__ = ('first', 'second', '_sequence')
+
     def __init__(self, first, second):
         self.first = first
         self.second = second
+        self._sequence = None
 
     def unify(self, value, cont, fail=fail_silent):
-        self.first.unify(value,
-                         lambda: self.second.unify(value, cont, fail),
-                         fail)
+        sequence = self._sequence
+        if sequence is None:
+            sequence = _constraints(self._conjuncts())
+            sequence = self._sequence = _chain(sequence, sequence, 2)
+        if sequence:
+            _conjoin(sequence, 0, value, cont, fail)
+        else:
+            second = self.second
+            self.first.unify(
+                value, lambda: second.unify(value, cont, fail), fail)
+
+    def _unify_memo(self, value, cont, fail, memo):
+        second = self.second
+        self.first._unify_memo(
+            value, lambda: second._unify_memo(value, cont, fail, memo),
+            fail, memo)
+
+    def _conjuncts(self):
+        conjuncts = []
+        pending = [self]
+        while pending:
+            pattern = pending.pop()
+            if isinstance(pattern, And):
+                pending.append(pattern.second)
+                pending.append(pattern.first)
+            elif pattern is not Return:     # adds nothing to the chain
+                conjuncts.append(pattern)
+        return conjuncts
+
+    def _sites(self):
+        first_conts, first_fails = self.first._sites()
+        if not first_conts:
+            return 0, first_fails
+        second_conts, second_fails = self.second._sites()
+        return second_conts, first_fails + second_fails
+
+    def _compile(self, ctx, value, cont, fail):
+        second = _Cont(lambda ctx: self.second._emit(ctx, value, cont, fail))
+        self.first._emit(ctx, value, second, fail)
+
+    def _flatten(self, ops, value, fail):
+        # Long chains of & are walked iteratively
+        for pattern in self._conjuncts():
+            pattern._flatten(ops, value, fail)
+
+    def _head(self):
+        # Tests passing on their value unchanged can be factored out
+        if isinstance(self.first, (Ensure, Constant)):
+            head = self.first._head()
+            if head[1] is Return:
+                return head[0], self.second, head[2]
+        return None
+
+    def _parts(self):
+        return self.first, self.second
 
     def __repr__(self):
         return "<%s and %s>" % (self.first, self.second)
@@ -257,62 +791,529 @@ class And(Unifiable):
 class Or(Unifiable):
     """Matches first argument. On failure, matches second argument"""
 
+    __slots__ = ('first', 'second', '_factored', '_choices')
+
     def __init__(self, first, second):
         self.first = first
         self.second = second
+        self._factored = None
+        self._choices = None
 
     def unify(self, value, cont, fail=fail_silent):
-        self.first.unify(value,
-                         cont,
-                         lambda *t: self.second.unify(value, cont, fail))
+        factored = self._factored
+        if factored is None:
+            factored = self._factor()
+        if factored is not self:
+            factored.unify(value, cont, fail)
+            return
+        choices = self._choices
+        if choices is None:
+            # A test as the last alternative fails like any other pattern
+            choices = _tests(self._alternatives())
+            choices = self._choices = _chain(choices, choices[:-1], 1)
+        if choices:
+            _disjoin(choices, 0, value, cont, fail)
+        else:
+            self.first.unify(value, cont, partial(
+                _otherwise, len(_STATE.trail), self.second, value, cont, fail))
+
+    def _unify_memo(self, value, cont, fail, memo):
+        factored = self._factor()
+        if factored is not self:
+            factored._unify_memo(value, cont, fail, memo)
+            return
+        self.first._unify_memo(value, cont, partial(
+            _otherwise_memo, len(_STATE.trail), self.second,
+            value, cont, fail, memo), memo)
+
+    def _alternatives(self):
+        alternatives = []
+        pending = [self]
+        while pending:
+            pattern = pending.pop()
+            if isinstance(pattern, Or):
+                pending.append(pattern.second)
+                pending.append(pattern.first)
+            else:
+                alternatives.append(pattern)
+        return alternatives
+
+    def _factor(self):
+        """Equivalent pattern testing common prefixes of alternatives once.
+
+        Subsequent alternatives starting with the same deterministic test
+        (a type check, lookup or constant) are merged, so that
+        A ** x | A ** y becomes A ** (x | y). Subsequent plain type checks
+        and constants are merged into a single isinstance() or set lookup.
+        """
+        if self._factored is not None:
+            return self._factored
+        alternatives = self._alternatives()
+        groups = []
+        for alternative in _merge_tests(alternatives):
+            head = alternative._head()
+            if head is None:
+                groups.append((None, None, alternative, []))
+            elif groups and groups[-1][0] == head[0]:
+                groups[-1][3].append(head[1])
+            else:
+                key, rest, rebuild = head
+                groups.append((key, rebuild, alternative, [rest]))
+        if len(groups) == len(alternatives):
+            self._factored = self
+            return self
+        factored = None
+        for key, rebuild, alternative, rests in reversed(groups):
+            if len(rests) > 1:
+                alternative = rebuild(_either(rests))
+            if factored is None:
+                factored = alternative
+            else:
+                factored = Or(alternative, factored)
+                factored._factored = factored
+        self._factored = factored
+        return factored
+
+    def _sites(self):
+        factored = self._factor()
+        if factored is not self:
+            return factored._sites()
+        first_conts, first_fails = self.first._sites()
+        if not first_fails:
+            return first_conts, 0
+        second_conts, second_fails = self.second._sites()
+        return first_conts + second_conts, second_fails
+
+    def _compile(self, ctx, value, cont, fail):
+        factored = self._factor()
+        if factored is not self:
+            factored._compile(ctx, value, cont, fail)
+            return
+        mark = ctx.fresh('_t')
+        ctx.emit('%s = len(%s.trail)' % (mark, ctx.ref(_STATE)))
+
+        def alternative(ctx, pattern, failed):
+            undone = ctx.fresh('_u')
+            ctx.emit('%s = %s(%s)' % (undone, ctx.ref(_unwind), mark))
+            self.second._emit(ctx, value, cont, fail)
+            ctx.emit('%s(%s)' % (ctx.ref(_rewind), undone))
+
+        self.first._emit(ctx, value, cont, _Fail(alternative))
+
+    def _flatten(self, ops, value, fail):
+        factored = self._factor()
+        if factored is not self:
+            factored._flatten(ops, value, fail)
+            return
+        # Each alternative starts from the bindings present at the mark
+        end = ops.label()
+        mark = ops.slot()
+        ops.emit(OP_MARK, result=mark)
+        alternatives = self._alternatives()
+        for alternative in alternatives[:-1]:
+            following = ops.label()
+            alternative._flatten(ops, value, following)
+            ops.emit(OP_JUMP, fail=end)
+            ops.place(following)
+            ops.emit(OP_UNWIND, value=mark)
+        alternatives[-1]._flatten(ops, value, fail)
+        ops.place(end)
+
+    def _parts(self):
+        return self.first, self.second
 
     def __repr__(self):
         return "<%s or %s>" % (self.first, self.second)
 
 
+#
+#   Chains of & and | are matched by a loop over their parts instead of
+#   recursing into each nested And or Or. Plain tests among the parts
+#   (see _predicate) are evaluated in the loop without any continuation.
+#
+
+# Short chains are matched by nested calls instead, which is faster unless
+# the loop can skip continuations for enough tests among the parts
+
+_SHORT_CHAIN = 8
+
+
+def _chain(parts, tested, least):
+    """parts from _tests() or _constraints() if the chain is long, or has
+    at least least tests among tested, else ()"""
+    if len(parts) > _SHORT_CHAIN:
+        return parts
+    if sum(1 for _, test in tested if test is not None) >= least:
+        return parts
+    return ()
+
+
+def _tests(patterns):
+    """Pairs of pattern and predicate for _conjoin() and _disjoin()"""
+    return tuple((pattern, _predicate(pattern)) for pattern in patterns)
+
+
+def _predicate(pattern):
+    """Function testing a value like pattern, if pattern neither extracts
+    nor binds anything and succeeds at most once"""
+    if pattern is Return:
+        return lambda value: True
+    if pattern is Fail:
+        return lambda value: False
+    if type(pattern) in (Ensure, OneOf, Subtype) and pattern.into is Return:
+        return pattern.match
+    if type(pattern) is If:
+        return pattern.condition
+    if type(pattern) is Constant:
+        return lambda value: value is pattern.value or value == pattern.value
+    if type(pattern) is And:
+        predicates = [_predicate(part) for part in pattern._conjuncts()]
+        if None not in predicates:
+            return lambda value: all(test(value) for test in predicates)
+    return None
+
+
+#
+#   A variable occurring in several parts of an &-chain is bound by the
+#   first of them. The following ones only compare values to it, so that
+#   they are tests as well, as long as they bind nothing else.
+#
+
+def _constraints(parts):
+    """Like _tests(), also testing parts which only compare values to
+    variables bound by the preceding parts"""
+    tests = []
+    bound = set()
+    for part in parts:
+        tests.append((part, _predicate(part) or _constraint(part, bound)))
+        bound.update(_binds(part))
+    return tuple(tests)
+
+
+def _binds(pattern):
+    """Variables bound whenever pattern succeeds"""
+    kind = type(pattern)
+    if kind is Variable:
+        return set([pattern])
+    if kind in (Match, Ensure, Attribute, Index, Subtype, MatchAny):
+        return _binds(pattern.into)
+    if kind is And:
+        return set().union(*map(_binds, pattern._conjuncts()))
+    if kind is Or:
+        return set.intersection(*map(_binds, pattern._alternatives()))
+    return set()
+
+
+def _constraint(pattern, bound):
+    """Function testing a value like pattern, if pattern only compares
+    values to the bound variables"""
+    kind = type(pattern)
+    if kind is Variable:
+        if pattern in bound:
+            return lambda value: value == pattern.value
+        return None
+    if kind in (Match, Attribute, Index):
+        test = _predicate(pattern.into) or _constraint(pattern.into, bound)
+        if test is None:
+            return None
+        match = pattern.match
+
+        def extract_and_test(value):
+            try:
+                matched = match(value)
+            except (IndexError, KeyError, AttributeError):
+                return False
+            return test(matched)
+        return extract_and_test
+    if kind in (Ensure, Subtype):
+        test = _predicate(pattern.into) or _constraint(pattern.into, bound)
+        if test is None:
+            return None
+        condition = pattern.match
+        return lambda value: condition(value) and test(value)
+    if kind is And:
+        tests = [_predicate(part) or _constraint(part, bound)
+                 for part in pattern._conjuncts()]
+        if None not in tests:
+            return lambda value: all(test(value) for test in tests)
+    return None
+
+
+def _conjoin(parts, start, value, cont, fail):
+    """Match value against all of parts[start:]"""
+    count = len(parts)
+    index = start
+    while index < count:
+        pattern, predicate = parts[index]
+        index += 1
+        if predicate is None:
+            if index < count:
+                # A closure is called with less overhead than a partial,
+                # which leaves more room for deep patterns
+                pattern.unify(
+                    value,
+                    lambda: _conjoin(parts, index, value, cont, fail),
+                    fail)
+            else:
+                pattern.unify(value, cont, fail)
+            return
+        if not predicate(value):
+            fail(pattern, value)
+            return
+    cont()
+
+
+def _disjoin(choices, start, value, cont, fail):
+    """Match value against the first of choices[start:] which does not fail"""
+    last = len(choices) - 1
+    index = start
+    while index < last:
+        pattern, predicate = choices[index]
+        index += 1
+        if predicate is None:
+            pattern.unify(value, cont, partial(
+                _alternative, len(_STATE.trail), choices, index,
+                value, cont, fail))
+            return
+        if predicate(value):
+            cont()
+            return
+    choices[last][0].unify(value, cont, fail)
+
+
+def _alternative(mark, choices, index, value, cont, fail,
+                 pattern=None, failed=None):
+    """Failure continuation of _disjoin(), trying the following choices"""
+    if mark == len(_STATE.trail):
+        _disjoin(choices, index, value, cont, fail)     # nothing to unbind
+        return
+    undone = _unwind(mark)
+    try:
+        _disjoin(choices, index, value, cont, fail)
+    finally:
+        _rewind(undone)
+
+
+def _otherwise(mark, second, value, cont, fail, pattern=None, failed=None):
+    """Failure continuation of a single Or, trying its second pattern"""
+    if mark == len(_STATE.trail):
+        second.unify(value, cont, fail)     # nothing to unbind
+        return
+    undone = _unwind(mark)
+    try:
+        second.unify(value, cont, fail)
+    finally:
+        _rewind(undone)
+
+
+def _otherwise_memo(mark, second, value, cont, fail, memo,
+                    pattern=None, failed=None):
+    """Failure continuation of a single Or within a Memoized pattern"""
+    undone = _unwind(mark)
+    try:
+        second._unify_memo(value, cont, fail, memo)
+    finally:
+        _rewind(undone)
+
+
+def _merge_tests(alternatives):
+    """Merge runs of alternative Subtypes or Constants"""
+    merged = []
+    for alternative in alternatives:
+        previous = merged[-1] if merged else None
+        if _types(alternative) and _types(previous):
+            merged[-1] = Subtype(_types(previous) + _types(alternative))
+        elif _values(alternative) and _values(previous):
+            merged[-1] = OneOf(_values(previous) | _values(alternative))
+        else:
+            merged.append(alternative)
+    return merged
+
+
+def _types(pattern):
+    if type(pattern) is Subtype and pattern.into is Return:
+        if isinstance(pattern.subtype, tuple):
+            return pattern.subtype
+        return pattern.subtype,
+    return ()
+
+
+def _values(pattern):
+    if type(pattern) is OneOf:
+        return pattern.values
+    if type(pattern) is Constant and _plain(pattern.value):
+        return frozenset([pattern.value])
+    return frozenset()
+
+
+# Types whose instances only equal instances of these types with the same
+# hash, so that looking them up in a set is the same as comparing with ==
+
+_PLAIN = frozenset([bool, int, float, complex, str, bytes, type(None)])
+try:
+    _PLAIN |= frozenset([long, unicode])
+except NameError:
+    pass
+
+
+def _plain(value):
+    """Whether a set of such values finds everything equal to it"""
+    if type(value) is tuple:
+        return all(_plain(item) for item in value)
+    return type(value) in _PLAIN
+
+
+def _either(alternatives):
+    """Or-chain of the given patterns"""
+    pattern = alternatives[-1]
+    for alternative in reversed(alternatives[:-1]):
+        pattern = Or(alternative, pattern)
+    return pattern
+
+
 class MatchAny(Unifiable):
     """Match elements of a collection."""
 
+    __slots__ = ('into', 'must_exist', 'only_once', '_condition', '_each')
+
     def __init__(self, must_exist, only_once, into):
         self.into = into
         self.must_exist = must_exist
         self.only_once = only_once
+        # Any ** If(condition) ** ... skips elements in a C-level filter
+        # instead of failing them one by one
+        if type(into) is Ensure:
+            self._condition, self._each = into.match, into.into
+        else:
+            self._condition, self._each = None, into
 
-    def unify(self, value, cont, fail=fail_silent):
-        matched_once = []
+    def _parts(self):
+        return self.into,
 
-        def continuation():
-            matched_once[:] = [True]
-            cont()
+    def _entries(self, value):
+        if self._condition is None:
+            return value
+        return _filter(self._condition, value)
 
-        for entry in value:
-            self.into.unify(entry, continuation, fail_silent)
-            if self.only_once and matched_once:
+    def unify(self, value, cont, fail=fail_silent):
+        self._match(self._each.unify, value, cont, fail)
+
+    def _unify_memo(self, value, cont, fail, memo):
+        if id(self) in memo.replayed and _replay(memo, self, value, cont, fail):
+            return
+        each = self._each
+        self._match(
+            lambda entry, cont, fail: each._unify_memo(entry, cont, fail, memo),
+            value, cont, fail)
+
+    def _match(self, unify, value, cont, fail):
+        """Match the entries of value using unify(entry, cont, fail)"""
+        # One context object per call keeps nested and recursive matches
+        # of the same pattern apart, at the cost of a single allocation
+        matched = _Matched(cont)
+        continuation = matched.succeed
+        for entry in self._entries(value):
+            unify(entry, continuation, fail_silent)
+            if self.only_once and matched.matched:
                 break
 
+        if self.must_exist and not matched.matched:
+            fail(self, value)
+
+    def _sites(self):
+        return 1, int(bool(self.must_exist))
+
+    def _compile(self, ctx, value, cont, fail):
+        matched = ctx.fresh('_m')
+        entry = ctx.fresh('_v')
+        ctx.emit('%s = [False]' % matched)
+
+        def set_matched(ctx):
+            ctx.emit('%s[0] = True' % matched)
+            cont(ctx)
+        continuation = ctx.share_cont(_Cont(set_matched))
+        if self._condition is None:
+            entries = value
+        else:
+            entries = '%s(%s, %s)' % (
+                ctx.ref(_filter), ctx.ref(self._condition), value)
+        ctx.emit('for %s in %s:' % (entry, entries))
+        with ctx.indented():
+            self._each._emit(ctx, entry, continuation, ctx.silent)
+            if self.only_once:
+                ctx.emit('if %s[0]:' % matched)
+                with ctx.indented():
+                    ctx.emit('break')
         if self.must_exist:
-            if not matched_once:
-                fail(self, value)
+            ctx.emit('if not %s[0]:' % matched)
+            with ctx.indented():
+                fail(ctx, ctx.ref(self), value)
+
+    def _flatten(self, ops, value, fail):
+        # The slot after the entry holds the flag set on every match
+        entry = ops.slot()
+        matched = ops.slot()
+        ops.emit(OP_EACH, self, value, entry, self, fail)
+        self.into._flatten(ops, entry, STOP)
+        ops.emit(OP_MATCHED, None, None, matched)
+
+
+class _Matched(object):
+    """Continuation recording whether any element of a MatchAny matched"""
+
+    __slots__ = ('cont', 'matched')
+
+    def __init__(self, cont):
+        self.cont = cont
+        self.matched = False
+
+    def succeed(self):
+        self.matched = True
+        self.cont()
 
 
 class MatchAll(Unifiable):
     """Match all elements of a collection. Fail if a single one fails"""
 
+    __slots__ = ('into', '_check')
+
     def __init__(self, into):
         self.into = into
+        # Leaf patterns are checked directly, without any continuation
+        self._check = _predicate(into) or self._succeeds
 
-    def unify(self, value, cont, fail=fail_silent):
-        failed_once = False
+    def _parts(self):
+        return self.into,
 
-        def failure(*_):
-            global failed_once
-            failed_once = True
+    def _succeeds(self, entry):
+        matched = []
+        self.into.unify(entry, lambda: matched.append(True), fail_silent)
+        return matched
 
+    def unify(self, value, cont, fail=fail_silent):
+        self._match(self._check, value, cont, fail)
+
+    def _unify_memo(self, value, cont, fail, memo):
+        if id(self) in memo.replayed and _replay(memo, self, value, cont, fail):
+            return
+        into = self.into
+
+        def check(entry):
+            matched = []
+            into._unify_memo(
+                entry, lambda: matched.append(True), fail_silent, memo)
+            return matched
+        self._match(check, value, cont, fail)
+
+    def _match(self, check, value, cont, fail):
+        """Continue if check(entry) holds for all entries of value"""
         for entry in value:
-            self.each.unify(entry, cont, failure)
-            if failed_once:
+            if not check(entry):
                 fail(self, value)
-                break
+                return
+        cont()
+
+
 #
 #   Monadic patterns.
 #
@@ -323,61 +1324,225 @@ class MatchAll(Unifiable):
 #
 
 
-class Attribute(PatternMonad):
-    """Chainable pattern looking up an attribute."""
+class Attribute(Match, PatternMonad):
+    """Chainable pattern looking up an attribute. Dotted names look up
+    a chain of attributes."""
+
+    __slots__ = ('name',)
 
-    def __init__(self, name):
+    def __init__(self, name, into=Return):
+        # Interned names are found in attribute dictionaries by identity
+        if type(name) is str:
+            name = _intern(name)
+        Match.__init__(self, operator.attrgetter(name), into)
         self.name = name
 
     def bind(self, bind):
-        return Match(lambda value: getattr(value, self.name), bind)
-
-
-class Subtype(PatternMonad):
+        if self.into is not Return:
+            return Attribute(self.name, self.into ** bind)
+        # Subsequent lookups are fused into a single chain
+        if type(bind) is Attribute:
+            return Attribute(self.name + '.' + bind.name, bind.into)
+        return Attribute(self.name, bind)
+
+    def _head(self):
+        # The first name of a chain is shared with other lookups
+        name, _, rest = self.name.partition('.')
+        if rest:
+            return (('attr', name), Attribute(rest, self.into),
+                    Attribute(name).bind)
+        return ('attr', self.name), self.into, Attribute(self.name).bind
+
+    def _extract(self, ctx, value):
+        if _is_path(self.name):
+            return '%s.%s' % (value, self.name)
+        return Match._extract(self, ctx, value)
+
+
+class Subtype(Ensure, PatternMonad):
     """Chainable pattern asserting a certain type"""
 
-    def __init__(self, subtype):
+    __slots__ = ('subtype', '_checked', '_token', '_static')
+
+    def __init__(self, subtype, into=Return):
         self.subtype = subtype
+        self.into = into
+        # isinstance() calls back into Python for abstract base classes
+        classes = subtype if isinstance(subtype, tuple) else (subtype,)
+        if any(isinstance(cls, ABCMeta) for cls in classes):
+            self._checked = {}
+            self.match = self._isinstance
+        else:
+            self._checked = None
+            self.match = lambda value: isinstance(value, subtype)
+        self._token = None
+        # Whether the exact type of a value decides the check, which does
+        # not hold for metaclasses with their own __instancecheck__
+        self._static = all(
+            getattr(type(cls), '__instancecheck__', None)
+            is type.__instancecheck__ for cls in classes)
 
     def bind(self, bind):
-        return Ensure(lambda value: isinstance(value, self.subtype), bind)
+        if self.into is not Return:
+            return Subtype(self.subtype, self.into ** bind)
+        return Subtype(self.subtype, bind)
+
+    def _head(self):
+        return ('type', self.subtype), self.into, Subtype(self.subtype).bind
+
+    def unify(self, value, cont, fail=fail_silent):
+        if self._checked is None:
+            ok = isinstance(value, self.subtype)
+        else:
+            ok = self._isinstance(value)
+        if ok:
+            self.into.unify(value, cont, fail)
+        else:
+            fail(self, value)
+
+    def _unify_memo(self, value, cont, fail, memo):
+        # Type checks are not worth remembering
+        if self._checked is None:
+            ok = isinstance(value, self.subtype)
+        else:
+            ok = self._isinstance(value)
+        if ok:
+            self.into._unify_memo(value, cont, fail, memo)
+        else:
+            fail(self, value)
+
+    def _isinstance(self, value):
+        """isinstance(value, self.subtype), remembered per type of value"""
+        checked = self._checked
+        token = _abc_token()
+        if token != self._token:
+            checked.clear()
+            self._token = token
+        kind = type(value)
+        try:
+            return checked[kind]
+        except KeyError:
+            pass
+        ok = isinstance(value, self.subtype)
+        # The check may also depend on __class__, which is rarely different
+        if getattr(value, '__class__', kind) is kind:
+            checked[kind] = ok
+        return ok
+
+    def _compile(self, ctx, value, cont, fail):
+        known = ctx.types.get(value)
+        if known is None or not self._static:
+            Ensure._compile(self, ctx, value, cont, fail)
+        elif issubclass(known, self.subtype):
+            self.into._emit(ctx, value, cont, fail)
+        else:
+            fail(ctx, ctx.ref(self), value)
+
+    def _test(self, ctx, value):
+        if self._checked is not None:
+            return '%s(%s)' % (ctx.ref(self._isinstance), value)
+        return 'isinstance(%s, %s)' % (value, ctx.ref(self.subtype))
+
+    def _step(self, ops, value, fail):
+        if self._checked is not None:
+            ops.emit(OP_TEST, self._isinstance, value, node=self, fail=fail)
+        else:
+            ops.emit(OP_TYPE, self.subtype, value, node=self, fail=fail)
+        return value
 
 
-class Index(PatternMonad):
+class Index(Match, PatternMonad):
     """Chainable pattern causing an index lookup"""
 
-    def __init__(self, index):
+    __slots__ = ('index',)
+
+    def __init__(self, index, into=Return):
+        Match.__init__(self, operator.itemgetter(index), into)
         self.index = index
 
     def bind(self, bind):
-        return Match(lambda value: value[self.index], bind)
+        if self.into is not Return:
+            return Index(self.index, self.into ** bind)
+        return Index(self.index, bind)
+
+    def _head(self):
+        return (('index', type(self.index), self.index), self.into,
+                Index(self.index).bind)
+
+    def _extract(self, ctx, value):
+        # Integer positions are emitted as literals, indexing with a constant
+        if type(self.index) is int:
+            return '%s[%d]' % (value, self.index)
+        return '%s[%s]' % (value, ctx.ref(self.index))
 
 
 class Get(PatternMonad):
     """Extract a value using the given function"""
 
+    __slots__ = ('extractor',)
+
     def __init__(self, extractor):
         self.extractor = extractor
 
     def bind(self, bind):
         return Match(self.extractor, bind)
 
+    @staticmethod
+    def attrchain(path):
+        """Look up a dotted chain of attributes"""
+        return Attribute(path)
+
 
 class If(PatternMonad):
     """Continue to match if condition is satisfied"""
 
+    __slots__ = ('condition',)
+
     def __init__(self, condition):
         self.condition = condition
 
     def bind(self, bind):
         return Ensure(self.condition, bind)
 
+    # Conditions as partially applied operators, with the operands swapped
+    # where the bound operand comes first
+
+    @classmethod
+    def lt(cls, bound):
+        return cls(partial(operator.gt, bound))
+
+    @classmethod
+    def le(cls, bound):
+        return cls(partial(operator.ge, bound))
+
+    @classmethod
+    def gt(cls, bound):
+        return cls(partial(operator.lt, bound))
+
+    @classmethod
+    def ge(cls, bound):
+        return cls(partial(operator.le, bound))
+
+    @classmethod
+    def eq(cls, other):
+        return cls(partial(operator.eq, other))
+
+    @classmethod
+    def ne(cls, other):
+        return cls(partial(operator.ne, other))
+
+    @classmethod
+    def in_(cls, collection):
+        return cls(partial(operator.contains, collection))
+
 
 class Any(PatternMonad):
     """Match elements inside collection, skipping those which do not match.
     must_exist: fail if no element matched.
     only_once: cut iteration after first match"""
 
+    __slots__ = ('must_exist', 'only_once')
+
     def __init__(self, must_exist=1, only_once=1):
         self.must_exist = must_exist
         self.only_once = only_once
@@ -393,5 +1558,691 @@ Each = Any(False, False)    # Match just each element (including none)
 class All(PatternMonad):
     """Matches all elements inside collection. Fails if any does not match"""
 
+    __slots__ = ()
+
     def bind(self, bind):
         return MatchAll(bind)
+
+
+#
+#   Pattern sets.
+#
+#   The patterns of a set are arranged in a tree of _Nets. Patterns
+#   starting with the same test or lookup (see Unifiable._head) share a
+#   single instance of it, continuing with a _Net of their remainders.
+#   The continuation passed through the tree receives the index of the
+#   pattern which matched.
+#
+
+
+class PatternSet(object):
+    """Matches many patterns against a value at once"""
+
+    __slots__ = ('patterns', 'keys', '_net')
+
+    def __init__(self):
+        self.patterns = []
+        self.keys = []
+        self._net = None
+
+    def add(self, pattern, key):
+        """Add a pattern, reported as key when it matches"""
+        self.patterns.append(pattern)
+        self.keys.append(key)
+        self._net = None
+
+    def match_all(self, value):
+        """Keys of all patterns matching value, in the order they were added"""
+        if self._net is None:
+            self._net = _Net(list(enumerate(self.patterns)))
+        found = set()
+        self._net.unify(value, found.add)
+        return [self.keys[index] for index in sorted(found)]
+
+
+class _Net(Unifiable):
+    """Patterns of a PatternSet with their common heads merged"""
+
+    __slots__ = ('branches', 'leaves')
+
+    def __init__(self, entries):
+        self.branches = []
+        self.leaves = []
+        groups = {}
+        order = []
+        for index, pattern in entries:
+            head = pattern._head()
+            try:
+                group = groups.get(head and head[0])
+            except TypeError:       # tests of unhashable constants
+                head = None
+            if head is None:
+                self.leaves.append((index, pattern))
+            elif group is None:
+                groups[head[0]] = head[2], [(index, head[1])]
+                order.append(head[0])
+            else:
+                group[1].append((index, head[1]))
+        for key in order:
+            rebuild, rests = groups[key]
+            if len(rests) == 1:
+                index, rest = rests[0]
+                self.leaves.append((index, rebuild(rest)))
+            else:
+                self.branches.append(rebuild(_Net(rests)))
+
+    def unify(self, value, found, fail=fail_silent):
+        for branch in self.branches:
+            branch.unify(value, found)
+        for index, pattern in self.leaves:
+            if pattern is Return:
+                found(index)
+            else:
+                pattern.unify(value, partial(found, index))
+
+    def _parts(self):
+        return tuple(self.branches) + tuple(p for _, p in self.leaves)
+
+
+def _walk(pattern):
+    """All patterns reachable from pattern"""
+    seen = set()
+    pending = [pattern]
+    while pending:
+        pattern = pending.pop()
+        if id(pattern) not in seen:
+            seen.add(id(pattern))
+            yield pattern
+            pending.extend(pattern._parts())
+
+
+#
+#   Memoization.
+#
+#   A Memoized pattern matches through _unify_memo(), passing down a memo
+#   created for each match. Its results map the identities of an extractor
+#   or condition and of the value it was applied to onto that value and the
+#   result. Keeping the value alive ensures its identity is not reused by
+#   another object during the match. Patterns matched with unify() never
+#   see a memo, even when matched from within a Memoized one.
+#
+#   Sub-patterns without variables only depend on the matched value. The
+#   ids of those doing more than a single test are kept in the replayed
+#   set of the memo. The continuations they call are recorded in the
+#   results under the ids of the pattern and the value, and called from
+#   the recording each time the pattern matches that value. Should the
+#   pattern raise, the calls recorded until then are made before the error
+#   propagates, as they would have been without the recording.
+#
+
+_FAILED = object()
+
+
+class _Memo(object):
+    """What is remembered during one match of a Memoized pattern"""
+
+    __slots__ = ('results', 'replayed')
+
+    def __init__(self, replayed):
+        self.results = {}
+        self.replayed = replayed
+
+
+def _remember(memo, test, value, lookup):
+    """Result of test(value), computed once per memoized match"""
+    key = (id(test), id(value))
+    results = memo.results
+    entry = results.get(key)
+    if entry is None:
+        if lookup:
+            try:
+                result = test(value)
+            except (IndexError, KeyError, AttributeError):
+                result = _FAILED
+        else:
+            result = test(value)
+        entry = results[key] = (value, result)
+    return entry[1]
+
+
+def _replay(memo, pattern, value, cont, fail):
+    """Call the continuations pattern calls when matching value, matching
+    it only the first time. False while it is being matched."""
+    key = (id(pattern), id(value))
+    results = memo.results
+    entry = results.get(key)
+    if entry is None:
+        # Without variables, the continuations can be called afterwards
+        calls = []
+        results[key] = (value, None)
+        finished = False
+        try:
+            pattern._unify_memo(value, lambda: calls.append(None),
+                                lambda failed, failed_value:
+                                    calls.append((failed, failed_value)),
+                                memo)
+            finished = True
+        finally:
+            if not finished:
+                # Make the calls that came before the error, then raise it
+                del results[key]
+                _call(calls, cont, fail)
+        entry = results[key] = (value, calls)
+    elif entry[1] is None:
+        return False
+    _call(entry[1], cont, fail)
+    return True
+
+
+def _call(calls, cont, fail):
+    """Call the continuations recorded by _replay()"""
+    for call in calls:
+        if call is None:
+            cont()
+        else:
+            fail(*call)
+
+
+def _replayable(pattern):
+    """Sub-patterns of pattern whose continuations can be replayed"""
+    return frozenset(
+        id(part) for part in _walk(pattern)
+        if isinstance(part, (Match, MatchAny, MatchAll))
+        and type(part) is not Subtype
+        and part.into is not Return
+        and _predicate(part) is None
+        and not any(isinstance(sub, Variable) for sub in _walk(part)))
+
+
+class Memoized(Unifiable):
+    """Remembers extracted values and conditions during each match"""
+
+    __slots__ = ('pattern', 'replayed')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.replayed = _replayable(pattern)
+
+    def unify(self, value, cont, fail=fail_silent):
+        self.pattern._unify_memo(value, cont, fail, _Memo(self.replayed))
+
+    def memoize(self):
+        return self
+
+    def _parts(self):
+        return self.pattern,
+
+    def __repr__(self):
+        return "<Memoized %s>" % self.pattern
+
+
+#
+#   Compiled patterns.
+#
+#   The code generated for a pattern tree is wrapped into a factory whose
+#   arguments are the objects referenced by the tree (sub-patterns,
+#   constants, extractor functions), so that the matcher accesses them
+#   as closure variables.
+#
+
+
+class Compiled(Unifiable):
+    """Runs a pattern as a single generated Python function"""
+
+    __slots__ = ('pattern', 'subtype', 'source', 'run', 'test')
+
+    def __init__(self, pattern, subtype=None):
+        # subtype: exact type of all values this will be matched against
+        self.pattern = pattern
+        self.subtype = subtype
+        self.test = None
+        try:
+            self.source, self.run = self._generate(False)
+        except (SyntaxError, RuntimeError):
+            # Too deeply nested to be compiled, keep interpreting
+            self.source = None
+            self.run = pattern.unify
+
+    def _generate(self, test):
+        """Source and function of the matcher, or of a function returning
+        whether its argument matches if test is set"""
+        ctx = _Source()
+        if self.subtype is not None:
+            ctx.types['value'] = self.subtype
+        ctx.depth = 2
+        if test:
+            parameters = 'value'
+            ctx.emit('_found = []')
+            self.pattern._emit(ctx, 'value', _Cont(_found), ctx.silent)
+            ctx.emit('return bool(_found)')
+        else:
+            parameters = 'value, cont, fail=%s' % ctx.ref(fail_silent)
+            self.pattern._emit(
+                ctx, 'value', _Cont(name='cont'), _Fail(name='fail'))
+        source = (
+            'def factory(%s):\n'
+            '    def run(%s):\n'
+            '%s\n'
+            '    return run\n') % (
+                ', '.join(name for name, _ in ctx.refs),
+                parameters,
+                '\n'.join(ctx.lines) or '        pass')
+        namespace = {}
+        exec(compile(source, '<pattern>', 'exec'), namespace)
+        return source, namespace['factory'](*[obj for _, obj in ctx.refs])
+
+    def unify(self, value, cont, fail=fail_silent):
+        # The generated code unbinds variables only on regular returns
+        mark = len(_STATE.trail)
+        try:
+            self.run(value, cont, fail)
+        except BaseException:
+            _unwind(mark)
+            raise
+
+    def matches(self, value):
+        if self.test is None:
+            if self.source is None:
+                self.test = partial(Unifiable.matches, self.pattern)
+            else:
+                self.test = self._generate(True)[1]
+        # The test returns on the first match, leaving variables bound
+        mark = len(_STATE.trail)
+        try:
+            return self.test(value)
+        finally:
+            _unwind(mark)
+
+    def compile(self):
+        return self
+
+    def _parts(self):
+        return self.pattern,
+
+    def _sites(self):
+        return self.pattern._sites()
+
+    def _compile(self, ctx, value, cont, fail):
+        self.pattern._compile(ctx, value, cont, fail)
+
+    def _flatten(self, ops, value, fail):
+        self.pattern._flatten(ops, value, fail)
+
+    def __repr__(self):
+        return "<Compiled %s>" % self.pattern
+
+
+class Specialized(Unifiable):
+    """Runs a pattern as generated code specific to the type of the value"""
+
+    __slots__ = ('pattern', 'compiled')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.compiled = {}
+
+    def _compiled_for(self, value):
+        subtype = type(value)
+        # isinstance() also accepts the type claimed by __class__
+        if getattr(value, '__class__', subtype) is not subtype:
+            subtype = None
+        compiled = self.compiled.get(subtype)
+        if compiled is None:
+            compiled = self.compiled[subtype] = Compiled(self.pattern, subtype)
+        return compiled
+
+    def unify(self, value, cont, fail=fail_silent):
+        self._compiled_for(value).unify(value, cont, fail)
+
+    def matches(self, value):
+        return self._compiled_for(value).matches(value)
+
+    def specialize(self):
+        return self
+
+    def _parts(self):
+        return self.pattern,
+
+    def _sites(self):
+        return self.pattern._sites()
+
+    def _compile(self, ctx, value, cont, fail):
+        self.pattern._compile(ctx, value, cont, fail)
+
+    def _flatten(self, ops, value, fail):
+        self.pattern._flatten(ops, value, fail)
+
+    def __repr__(self):
+        return "<Specialized %s>" % self.pattern
+
+
+class _Source(object):
+    """Generated lines of code and the objects they refer to"""
+
+    def __init__(self):
+        self.lines = []
+        self.depth = 0
+        self.refs = []
+        self.names = {}
+        self.count = 0
+        self.types = {}         # exact types of values known in advance
+        self.scope = 0          # nesting of local functions
+
+    def fresh(self, prefix):
+        self.count += 1
+        return '%s%s' % (prefix, self.count)
+
+    def ref(self, obj):
+        name = self.names.get(id(obj))
+        if name is None:
+            name = self.names[id(obj)] = self.fresh('_r')
+            self.refs.append((name, obj))
+        return name
+
+    def emit(self, line):
+        self.lines.append('    ' * self.depth + line)
+
+    @contextmanager
+    def indented(self):
+        self.depth += 1
+        size = len(self.lines)
+        yield
+        if len(self.lines) == size:
+            self.emit('pass')
+        self.depth -= 1
+
+    @property
+    def silent(self):
+        return _Fail(silent=True)
+
+    def share_cont(self, cont):
+        """Turn a success emitter into a local function"""
+        if cont.name is None:
+            name = self.fresh('_k')
+            self.emit('def %s():' % name)
+            self.scope += 1
+            with self.indented():
+                cont(self)
+            self.scope -= 1
+            cont = _Cont(name=name)
+        return cont
+
+    def share_fail(self, fail):
+        """Turn a failure emitter into a local function"""
+        if fail.silent:
+            return _Fail(name=self.ref(fail_silent))
+        if fail.name is None:
+            name = self.fresh('_f')
+            pattern, value = self.fresh('_p'), self.fresh('_v')
+            self.emit('def %s(%s, %s):' % (name, pattern, value))
+            self.scope += 1
+            with self.indented():
+                fail(self, pattern, value)
+            self.scope -= 1
+            fail = _Fail(name=name)
+        return fail
+
+
+def _found(ctx):
+    # Success of a generated test. Inside a local function, the test can
+    # only return after that function did, so the match is recorded.
+    if ctx.scope:
+        ctx.emit('_found.append(True)')
+    else:
+        ctx.emit('return True')
+
+
+def _is_path(name):
+    """Whether name can be looked up as value.name in generated code"""
+    return all(re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', part) and
+               not keyword.iskeyword(part)
+               for part in name.split('.'))
+
+
+class _Cont(object):
+    """Emits the code run after a successful match"""
+
+    __slots__ = ('emit', 'name')
+
+    def __init__(self, emit=None, name=None):
+        self.emit = emit
+        self.name = name
+
+    def __call__(self, ctx):
+        if self.name is None:
+            self.emit(ctx)
+        else:
+            ctx.emit('%s()' % self.name)
+
+
+class _Fail(object):
+    """Emits the code run after a failed match"""
+
+    __slots__ = ('emit', 'name', 'silent')
+
+    def __init__(self, emit=None, name=None, silent=False):
+        self.emit = emit
+        self.name = name
+        self.silent = silent
+
+    def __call__(self, ctx, pattern, value):
+        if self.silent:
+            ctx.emit('pass')
+        elif self.name is None:
+            self.emit(ctx, pattern, value)
+        else:
+            ctx.emit('%s(%s, %s)' % (self.name, pattern, value))
+
+
+
+#
+#   Instruction loop.
+#
+#   A flattened pattern is a sequence of instructions
+#       (opcode, argument, value slot, result slot, fail target, pattern)
+#   which a Program stores field by field in parallel arrays, so that the
+#   loop only reads the fields an instruction uses.
+#   Matched values live in numbered slots instead of Python locals.
+#   Success continues with the next instruction, failure jumps to the
+#   fail target. Whenever a path ends (by calling the continuation, the
+#   failure continuation or by failing silently), the loop resumes the
+#   most recent pending work on its stack: unbinding a variable,
+#   restoring bindings removed for an alternative or advancing the
+#   iteration over a collection.
+#
+
+OP_STOP = 0         # end the current path
+OP_RAISE = 1        # call the failure continuation, end the path
+OP_SUCCEED = 2      # call the success continuation, end the path
+OP_JUMP = 3         # continue at the fail target
+OP_FAIL = 4         # fail unconditionally
+OP_EQ = 5           # compare to a constant
+OP_VAR = 6          # unify with a variable
+OP_CALL = 7         # extract a value into the result slot
+OP_TEST = 8         # check a predicate
+OP_EACH = 9         # iterate a collection into the result slot
+OP_MATCHED = 10     # flag an element of the current iteration as matched
+OP_UNIFY = 11       # call the interpreter
+OP_TYPE = 12        # check the type
+OP_MARK = 13        # store the height of the trail
+OP_UNWIND = 14      # unbind variables above the stored height
+
+STOP = 0            # target of silent failures
+RAISE = 1           # target of failures passed to the caller
+START = 2           # first instruction of the pattern
+
+
+class Program(Unifiable):
+    """Runs a pattern as a flat list of instructions"""
+
+    __slots__ = ('pattern', 'opcodes', 'args', 'values', 'results', 'targets',
+                 'nodes', 'slots')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        ops = _Ops()
+        pattern._flatten(ops, 0, RAISE)
+        ops.emit(OP_SUCCEED)
+        (self.opcodes, self.args, self.values,
+         self.results, self.targets, self.nodes) = ops.resolve()
+        self.slots = ops.slots
+
+    def unify(self, value, cont, fail=fail_silent):
+        regs = [None] * self.slots
+        regs[0] = value
+        mark = len(_STATE.trail)
+        try:
+            run(self, regs, START, cont, fail)
+        except BaseException:
+            _unwind(mark)
+            raise
+
+    def flatten(self):
+        return self
+
+    def _parts(self):
+        return self.pattern,
+
+    def _flatten(self, ops, value, fail):
+        self.pattern._flatten(ops, value, fail)
+
+    def __repr__(self):
+        return "<Program %s>" % self.pattern
+
+
+class _Ops(object):
+    """Instructions being generated, with labels for forward jumps"""
+
+    def __init__(self):
+        self.ops = [(OP_STOP, None, None, None, None, None),
+                    (OP_RAISE, None, None, None, None, None)]
+        self.slots = 1
+
+    def emit(self, op, arg=None, value=None, result=None, node=None, fail=None):
+        self.ops.append((op, arg, value, result, fail, node))
+
+    def slot(self):
+        self.slots += 1
+        return self.slots - 1
+
+    def label(self):
+        return []
+
+    def place(self, label):
+        label.append(len(self.ops))
+
+    def resolve(self):
+        """Instruction fields as parallel arrays, labels replaced"""
+        opcodes, args, values, results, targets, nodes = zip(*self.ops)
+        targets = [target[0] if isinstance(target, list) else target
+                   for target in targets]
+        return (array('b', opcodes), args,
+                _indices(values), _indices(results), _indices(targets),
+                nodes)
+
+
+def _indices(numbers):
+    return array('i', [-1 if number is None else number for number in numbers])
+
+
+_END = object()
+
+
+def run(program, regs, pc, cont, fail, failed=(None, None)):
+    """Execute instructions starting at pc until all paths ended"""
+    opcodes = program.opcodes
+    args = program.args
+    values = program.values
+    results = program.results
+    targets = program.targets
+    trail = _STATE.trail
+    stack = []
+    failed_node, failed_value = failed
+    while True:
+        op = opcodes[pc]
+        if op == OP_EQ:
+            value = regs[values[pc]]
+            ok = value is args[pc] or value == args[pc]
+        elif op == OP_TYPE:
+            ok = isinstance(regs[values[pc]], args[pc])
+        elif op == OP_CALL:
+            try:
+                regs[results[pc]] = args[pc](regs[values[pc]])
+                ok = True
+            except (IndexError, KeyError, AttributeError):
+                ok = False
+        elif op == OP_TEST:
+            ok = args[pc](regs[values[pc]])
+        elif op == OP_VAR:
+            var = args[pc]
+            if var.bound:
+                ok = regs[values[pc]] == var.value
+            else:
+                var.bound = True
+                var.value = regs[values[pc]]
+                trail.append(var)
+                stack.append((pc, None))
+                ok = True
+        elif op == OP_JUMP:
+            pc = targets[pc]
+            continue
+        elif op == OP_MATCHED:
+            regs[results[pc]] = True
+            ok = True
+        elif op == OP_MARK:
+            regs[results[pc]] = len(trail)
+            ok = True
+        elif op == OP_UNWIND:
+            stack.append((pc, _unwind(regs[values[pc]])))
+            ok = True
+        elif op == OP_FAIL:
+            ok = False
+        else:
+            if op == OP_SUCCEED:
+                cont()
+            elif op == OP_RAISE:
+                fail(failed_node, failed_value)
+            elif op == OP_EACH:
+                regs[results[pc] + 1] = False
+                stack.append((pc, iter(regs[values[pc]])))
+            elif op == OP_UNIFY:
+                args[pc].unify(
+                    regs[values[pc]],
+                    lambda pc=pc + 1: run(program, regs, pc, cont, fail),
+                    lambda node=None, failed=None, pc=targets[pc]: run(
+                        program, regs, pc, cont, fail, (node, failed)))
+
+            # The current path ended, resume pending work
+            while stack:
+                pc, entries = stack.pop()
+                op = opcodes[pc]
+                if op == OP_VAR:
+                    var = trail.pop()
+                    var.bound = False
+                    var.value = None
+                    continue
+                if op == OP_UNWIND:
+                    _rewind(entries)
+                    continue
+                node = args[pc]
+                matched = results[pc] + 1
+                if not (node.only_once and regs[matched]):
+                    entry = next(entries, _END)
+                    if entry is not _END:
+                        regs[results[pc]] = entry
+                        stack.append((pc, entries))
+                        pc += 1
+                        break
+                if node.must_exist and not regs[matched]:
+                    failed_node, failed_value = node, regs[values[pc]]
+                    pc = targets[pc]
+                    break
+            else:
+                return
+            continue
+
+        if ok:
+            pc += 1
+        else:
+            failed_node, failed_value = program.nodes[pc], regs[values[pc]]
+            pc = targets[pc]
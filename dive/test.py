@@ -1,11 +1,13 @@
 from patterns import *
+from abc import ABCMeta
+import threading
 import unittest
 
 class TestUnifiable(unittest.TestCase):
 
-    def setUp(self):
-        self.failed = False
-        self.unified = False
+    # Overridden per test instance once set
+    failed = False
+    unified = False
 
     def should_fail(self, term1, term2):
         self.failed = True
@@ -16,13 +18,20 @@ class TestUnifiable(unittest.TestCase):
     def should_not_unify(self):
         self.fail("Should not have matched")
 
-    def assert_unifies(self, pattern, against, continuation=lambda:None):
-        def inner_continuation():
-            self.unified = True
-            continuation()
-            
+    def should_unify(self):
+        self.unified = True
+
+    def assert_unifies(self, pattern, against, continuation=None):
+        if continuation is None:
+            inner_continuation = self.should_unify
+        else:
+            def inner_continuation():
+                self.unified = True
+                continuation()
+
         pattern.unify(against, inner_continuation, self.should_not_fail)
-        self.assertTrue(self.unified)
+        if not self.unified:
+            self.fail("Should have matched %r against %r" % (pattern, against))
 
     def assert_fails(self, pattern, against):
         pattern.unify(against, self.should_not_unify, self.should_fail)
@@ -42,16 +51,45 @@ class MockMock(object):
         self.bar = [1, 2, 3]
         self.mock = Mock(42)
 
+
+# Patterns without variables are shared by all tests
+ANY = Anything()
+NONE = Nothing()
+SUB_MOCK = Subtype(Mock)
+ATTR_FOO = Attribute('foo')
+ATTR_BAR = Attribute('bar')
+
         
 class TestPatterns(TestUnifiable):
 
+    def counted_get(self):
+        """Get of the foo attribute, and the list of values it looked up"""
+        lookups = []
+
+        def lookup(value):
+            lookups.append(value)
+            return value.foo
+
+        return Get(lookup), lookups
+
     def test_anything(self):
-        self.assert_unifies(Anything(), 42)
-        self.assert_unifies(Anything(), '42')
+        self.assert_unifies(ANY, 42)
+        self.assert_unifies(ANY, '42')
 
     def test_nothing(self):
-        self.assert_fails(Nothing(), 42)
-        self.assert_fails(Nothing(), '42')
+        self.assert_fails(NONE, 42)
+        self.assert_fails(NONE, '42')
+
+    def test_anything_and_nothing_are_shared(self):
+        self.assertIs(Anything(), ANY)
+        self.assertIs(Nothing(), NONE)
+        v = Variable()
+
+        def continuation():
+            self.assertEqual(v.value, 42)
+
+        self.assert_unifies(Anything() & v & Anything(), 42, continuation)
+        self.assert_fails(v & Nothing(), 42)
 
     def test_variable_binds(self):
         v = Variable()
@@ -70,20 +108,91 @@ class TestPatterns(TestUnifiable):
             
         self.assert_unifies(v, 42, continuation)
 
+    def test_variable_ids(self):
+        v, w = Variable(), Variable()
+        self.assertTrue(w.id > v.id)
+        self.assertFalse(hasattr(v, '__dict__'))
+
+    def test_patterns_have_slots(self):
+        v = Variable()
+        pattern = (SUB_MOCK ** ATTR_FOO ** (Constant(1) | v)
+                   & Each ** If(bool) & All() ** Index(0) & Get(len))
+        for node in [pattern, pattern.memoize(), pattern.compile(),
+                     pattern.flatten(), OneOf([1, 2]), Return, Fail]:
+            self.assertFalse(hasattr(node, '__dict__'), node)
+
+    def test_constant(self):
+        self.assert_unifies(Constant(42), 42)
+        self.assert_unifies(Constant([1, 2]), [1, 2])
+        self.assert_fails(Constant(42), 21)
+        self.assert_fails(Constant(42), '42')
+
+    def test_constant_interned(self):
+        self.assertIs(Constant('foo'), Constant('foo'))
+        self.assertIsNot(Constant(1), Constant(1.0))
+        self.assertIsNot(Constant([1]), Constant([1]))
+        # Equal containers may hold elements of other types
+        earlier = Constant((1,)), Constant(frozenset([1]))
+        self.assertIs(True, Constant((True,)).value[0])
+        self.assertIs(True, next(iter(Constant(frozenset([True])).value)))
+
     def test_attribute(self):
         m = Mock(42)
-        self.assert_unifies(Attribute('foo'), m)
+        self.assert_unifies(ATTR_FOO, m)
+
+    def test_attribute_name_interned(self):
+        name = ''.join(['f', 'oo'])
+        self.assertIs(Attribute(name).name, 'foo')
 
     def test_attribute_missing(self):
         m = Mock(42)
-        self.assert_fails(Attribute('bar'), m)
+        self.assert_fails(ATTR_BAR, m)
 
     def test_subtype(self):
         m = Mock(42)
-        self.assert_unifies(Subtype(Mock), m)
+        self.assert_unifies(SUB_MOCK, m)
+        self.assertTrue(SUB_MOCK.match(m))
+        self.assertFalse(SUB_MOCK.match(42))
 
     def test_wrong_subtype(self):
-        self.assert_fails(Subtype(Mock), 42)
+        self.assert_fails(SUB_MOCK, 42)
+
+    def test_abstract_subtype(self):
+        Base = ABCMeta('Base', (object,), {})
+        pattern = Subtype(Base) ** ATTR_FOO
+        self.assert_fails(pattern, Mock(42))
+        Base.register(Mock)
+        self.assert_unifies(pattern, Mock(42))
+
+    def test_subtype_claimed_by_class(self):
+        class Proxy(object):
+            __class__ = property(lambda self: Mock)
+            foo = 42
+
+        self.assert_unifies(SUB_MOCK ** ATTR_FOO, Proxy())
+        self.assert_fails(Subtype(Proxy) ** ATTR_FOO, Mock(42))
+
+    def test_subtype_chain(self):
+        v = Variable()
+
+        def continuation():
+            self.assertEqual(42, v.value)
+
+        self.assert_unifies(SUB_MOCK ** ATTR_FOO ** v, Mock(42), continuation)
+        self.assert_fails(SUB_MOCK ** ATTR_BAR ** v, Mock(42))
+
+    def test_chain_extended_at_its_end(self):
+        v = Variable()
+
+        def continuation():
+            self.assertEqual(42, v.value)
+
+        pattern = (SUB_MOCK ** ATTR_FOO) ** v
+        self.assert_unifies(pattern, Mock(42), continuation)
+        pattern = (Index(0) ** Index(5)) ** v
+        self.assert_fails(pattern, [[1]])
+        self.assert_unifies(pattern, [[0, 1, 2, 3, 4, 42]], continuation)
+        self.assertRaises(TypeError, lambda: (ATTR_FOO ** Constant(1)) ** v)
 
     def test_and(self):
         v = Variable()
@@ -91,13 +200,13 @@ class TestPatterns(TestUnifiable):
         def continuation():
             self.assertEqual(42, v.value)
             
-        self.assert_unifies(And(Anything(), v), 42, continuation)
-        self.assert_unifies(And(v, Anything()), 42, continuation)
+        self.assert_unifies(And(ANY, v), 42, continuation)
+        self.assert_unifies(And(v, ANY), 42, continuation)
 
     def test_not_and(self):
-        self.assert_fails(And(Anything(), Nothing()), 42)
-        self.assert_fails(And(Nothing(), Anything()), 42)
-        self.assert_fails(And(Nothing(), Nothing()), 42)
+        self.assert_fails(And(ANY, NONE), 42)
+        self.assert_fails(And(NONE, ANY), 42)
+        self.assert_fails(And(NONE, NONE), 42)
 
     def test_or(self):
         v = Variable()
@@ -109,12 +218,196 @@ class TestPatterns(TestUnifiable):
             # v should not be bound
             self.assertEqual(None, v.value)
 
-        self.assert_unifies(Or(v, Nothing()), 42, continuation1)
-        self.assert_unifies(Or(Nothing(), v), 42, continuation1)
-        self.assert_unifies(Or(Anything(), v), 42, continuation2)
+        self.assert_unifies(Or(v, NONE), 42, continuation1)
+        self.assert_unifies(Or(NONE, v), 42, continuation1)
+        self.assert_unifies(Or(ANY, v), 42, continuation2)
+
+    def test_or_unbinds_failed_branch(self):
+        v = Variable()
+        m = MockMock()
+
+        def continuation():
+            self.assertEqual([1, 2, 3], v.value)
+
+        pattern = (ATTR_FOO ** v & NONE
+                   | ATTR_BAR ** v)
+        self.assert_unifies(pattern, m, continuation)
+        self.assertFalse(v.bound)
+
+    def test_exception_unbinds(self):
+        v = Variable()
+
+        def continuation():
+            raise ValueError()
+
+        self.assertRaises(ValueError, self.assert_unifies,
+                          NONE | ANY & v, 42, continuation)
+        self.assertFalse(v.bound)
 
     def test_not_or(self):
-        self.assert_fails(Or(Nothing(), Nothing()), 42)
+        self.assert_fails(Or(NONE, NONE), 42)
+
+    def test_or_common_prefix(self):
+        get, lookups = self.counted_get()
+        v = Variable()
+        pattern = (SUB_MOCK ** get ** Constant(1)
+                   | SUB_MOCK ** get ** (Constant(42) & v)
+                   | SUB_MOCK ** get ** Constant(3))
+
+        def continuation():
+            self.assertEqual(42, v.value)
+
+        self.assert_unifies(pattern, Mock(42), continuation)
+        self.assertEqual(1, len(lookups))
+        self.assert_fails(pattern, Mock(2))
+        self.assert_fails(pattern, 42)
+
+    def test_long_chains(self):
+        pattern = Constant(42)
+        for _ in range(500):
+            pattern = pattern & If(lambda x: x > 0)
+        self.assert_unifies(pattern, 42)
+        self.assert_fails(pattern, -1)
+        choices = Constant(0)
+        for n in range(1, 500):
+            choices = choices | Constant(n) & If(lambda x: x > 0)
+        self.assert_unifies(choices, 499)
+
+    def test_repeated_variable(self):
+        v = Variable()
+        pattern = ATTR_FOO ** v & Attribute('mock') ** ATTR_FOO ** v
+
+        def continuation():
+            self.assertEqual(42, v.value)
+
+        self.assert_unifies(pattern, MockMock(), continuation)
+        m = MockMock()
+        m.mock.foo = 21
+        self.assert_fails(pattern, m)
+        self.assertFalse(v.bound)
+        # The second lookup only compares to v
+        from patterns import _constraints
+        self.assertIsNotNone(_constraints(pattern._conjuncts())[1][1])
+
+    def test_or_keeps_order(self):
+        matches = []
+        v = Variable()
+        pattern = (Subtype(int) & Constant(1) & v
+                   | ANY & v
+                   | Subtype(int) & Constant(1) & v)
+
+        def continuation():
+            matches.append(v.value)
+
+        self.assert_unifies(pattern, 1, continuation)
+        self.assertListEqual(matches, [1])
+
+    def test_memoize(self):
+        get, lookups = self.counted_get()
+        pattern = get ** Constant(1) | Constant(0) | get ** Constant(42)
+        self.assert_unifies(pattern.memoize(), Mock(42))
+        self.assertEqual(1, len(lookups))
+        self.assert_fails(pattern.memoize(), Mock(2))
+        self.assertIs(get.memoize(), get)
+
+    def test_memoize_is_confined_to_pattern(self):
+        get, lookups = self.counted_get()
+        other = get ** Constant(42)
+        m = Mock(42)
+
+        def continuation():
+            other.unify(m, lambda: None)
+            other.unify(m, lambda: None)
+
+        pattern = (ATTR_FOO ** Constant(1) | ANY).memoize()
+        self.assert_unifies(pattern, m, continuation)
+        self.assertEqual(2, len(lookups))
+
+    def test_memoize_replays_subpatterns(self):
+        iterations = []
+
+        class Numbers(list):
+            def __iter__(self):
+                iterations.append(self)
+                return list.__iter__(self)
+
+        m = MockMock()
+        m.bar = Numbers([1, 2, 3])
+        v = Variable()
+        numbers = ATTR_BAR ** Some ** If(lambda x: x < 3)
+        pattern = (numbers & ATTR_BAR ** Index(0) ** v & NONE
+                   | numbers & ATTR_FOO ** v).memoize()
+
+        def continuation():
+            self.assertEqual(42, v.value)
+
+        self.assert_unifies(pattern, m, continuation)
+        self.assertEqual(1, len(iterations))
+        self.assert_fails(pattern, Mock(42))
+
+    def test_memoize_replays_before_errors(self):
+        calls = []
+        pattern = ATTR_BAR ** Each ** Each ** ANY | NONE
+        m = MockMock()
+        m.bar = [[1], 2]
+        for matched in (pattern, pattern.memoize()):
+            del calls[:]
+            self.assertRaises(TypeError, matched.unify, m,
+                              lambda: calls.append(None))
+            self.assertEqual([None], calls)
+
+    def test_pattern_set(self):
+        get, lookups = self.counted_get()
+        v = Variable()
+        patterns = PatternSet()
+        patterns.add(SUB_MOCK ** get ** Constant(1), 'one')
+        patterns.add(SUB_MOCK ** get ** v, 'foo')
+        patterns.add(SUB_MOCK ** get ** Constant(42), 'answer')
+        patterns.add(Subtype(list) ** Index(0), 'sequence')
+        patterns.add(Constant([1]), 'list')
+        self.assertEqual(['foo', 'answer'], patterns.match_all(Mock(42)))
+        self.assertEqual(1, len(lookups))
+        self.assertEqual(['sequence', 'list'], patterns.match_all([1]))
+        self.assertEqual([], patterns.match_all(42))
+        self.assertFalse(v.bound)
+
+    def test_or_of_subtypes(self):
+        pattern = Subtype(int) | Subtype(str) | SUB_MOCK
+        self.assertIsInstance(pattern._factor(), Subtype)
+        self.assert_unifies(pattern, 42)
+        self.assert_unifies(pattern, '42')
+        self.assert_unifies(pattern, Mock(42))
+        self.assert_fails(pattern, 4.2)
+
+    def test_or_of_constants(self):
+        pattern = Constant(1) | Constant(2) | Constant([3])
+        self.assertIsInstance(pattern._factor().first, OneOf)
+        self.assert_unifies(pattern, 2)
+        self.assert_unifies(pattern, [3])
+        self.assert_fails(pattern, 3)
+        self.assert_fails(pattern, [4])
+
+    def test_or_of_constants_compares_values(self):
+        class Loose(object):
+            # Equal to 1, but with another hash
+            def __eq__(self, other):
+                return other == 1
+
+            def __ne__(self, other):
+                return not self == other
+
+            def __hash__(self):
+                return 0
+
+        class Unhashable(Loose):
+            __hash__ = None
+
+        pattern = Constant(1) | Constant(2)
+        self.assertIsInstance(pattern._factor(), OneOf)
+        self.assert_unifies(pattern, Loose())
+        self.assert_unifies(pattern, Unhashable())
+        self.assert_unifies(Constant(Loose()) | Constant(2), 1)
+        self.assert_fails(pattern, 3)
 
     def test_index(self):
         list = [1, 2, 3]
@@ -145,7 +438,7 @@ class TestPatterns(TestUnifiable):
         def continuation():
             matches.append(v.value)
 
-        self.assert_unifies(Attribute('bar') ** Some ** (If(lambda x: x < 3) & v), m, continuation)
+        self.assert_unifies(ATTR_BAR ** Some ** (If(lambda x: x < 3) & v), m, continuation)
         self.assertListEqual(matches, [1, 2])
 
     def test_each(self):
@@ -159,6 +452,135 @@ class TestPatterns(TestUnifiable):
         self.assert_unifies(Each ** (If(lambda x: x >= 3) & v), list, continuation)
         self.assertListEqual(matches, [3, 4])
 
+    def test_each_if(self):
+        list = [1, 2, 3, 4]
+        v = Variable()
+        matches = []
+
+        def continuation():
+            matches.append(v.value)
+
+        self.assert_unifies(Each ** If(lambda x: x < 3) ** v, list, continuation)
+        self.assertListEqual(matches, [1, 2])
+
+    def test_matches(self):
+        v = Variable()
+        self.assertTrue((SUB_MOCK ** ATTR_FOO ** v).matches(Mock(42)))
+        self.assertFalse((SUB_MOCK ** ATTR_BAR ** v).matches(Mock(42)))
+        self.assertTrue((Each ** v).matches([1, 2]))
+        self.assertFalse((Each ** v).matches([]))
+        self.assertFalse(v.bound)
+
+    def test_matches_stops_at_first(self):
+        v = Variable()
+        seen = []
+        pattern = Each ** If(lambda x: seen.append(x) or True) ** v | ANY
+        for matched in (pattern, pattern.flatten()):
+            del seen[:]
+            self.assertTrue(matched.matches([1, 2, 3]))
+            self.assertEqual([1], seen)
+            self.assertFalse(v.bound)
+
+    def test_solutions(self):
+        v, w = Variable(), Variable()
+        pattern = Each ** If(lambda x: x < 3) ** v
+        self.assertEqual(pattern.solutions([1, 2, 3]), [{v: 1}, {v: 2}])
+        pattern = Index(0) ** v & Index(1) ** w
+        self.assertEqual(pattern.solutions([1, 2]), [{v: 1, w: 2}])
+        self.assertEqual(pattern.solutions([1]), [])
+        self.assertFalse(v.bound or w.bound)
+
+    def test_threads_keep_their_bindings(self):
+        w = Variable()
+        bound, done = threading.Event(), threading.Event()
+        thread = threading.Thread(
+            target=lambda: w.unify(1, lambda: bound.set() or done.wait()))
+
+        def wait(value):
+            # w gets bound after the alternatives were entered
+            thread.start()
+            self.assertTrue(bound.wait(10))
+            return value
+
+        def continuation():
+            self.assertEqual(w.value, 1)
+
+        try:
+            self.assert_unifies(Get(wait) ** NONE | ANY, 42, continuation)
+        finally:
+            done.set()
+            thread.join()
+
+    def test_some_reentrant(self):
+        pattern = Some ** If(lambda x: x > 1)
+
+        def continuation():
+            self.assert_fails(pattern, [0, 1])
+
+        self.assert_unifies(pattern, [2], continuation)
+
+    def test_all(self):
+        list = [1, 2, 3, 4]
+        calls = []
+
+        def continuation():
+            calls.append(True)
+
+        self.assert_unifies(All() ** If(lambda x: x < 5), list, continuation)
+        self.assert_unifies(All() ** Subtype(int), list, continuation)
+        self.assert_unifies(All() ** (Subtype(int) & Variable()), list, continuation)
+        self.assertEqual(3, len(calls))
+
+    def test_not_all(self):
+        self.assert_fails(All() ** If(lambda x: x < 3), [1, 2, 3, 4])
+        self.assert_fails(All() ** Constant(1), [1, 2])
+        self.assert_fails(All() ** ATTR_FOO, [Mock(1), 2])
+
+    def test_if_operators(self):
+        list = [1, 2, 3, 4]
+        v = Variable()
+        matches = []
+
+        def continuation():
+            matches.append(v.value)
+
+        for condition in (If.lt(3), If.le(3), If.gt(3), If.ge(3),
+                          If.eq(3), If.ne(3), If.in_([1, 4])):
+            self.assert_unifies(Some ** condition ** v, list, continuation)
+        self.assertListEqual(matches, [1, 2, 1, 2, 3, 4, 3, 4, 3, 1, 2, 4, 1, 4])
+        self.assert_fails(If.gt(3), 3)
+
+    def test_attrchain(self):
+        v = Variable()
+
+        def continuation():
+            self.assertEqual(42, v.value)
+
+        self.assert_unifies(Get.attrchain('mock.foo') ** v, MockMock(), continuation)
+        self.assert_fails(Get.attrchain('mock.bar'), MockMock())
+
+    def test_attribute_chain_fused(self):
+        v = Variable()
+        pattern = Attribute('mock') ** ATTR_FOO ** v
+        self.assertEqual(pattern.name, 'mock.foo')
+
+        def continuation():
+            self.assertEqual(v.value, 42)
+
+        self.assert_unifies(pattern, MockMock(), continuation)
+
+    def test_or_shares_attribute_chain(self):
+        v = Variable()
+        pattern = (Attribute('mock') ** ATTR_BAR ** v |
+                   Attribute('mock') ** ATTR_FOO ** v)
+        factored = pattern._factor()
+        self.assertEqual(factored.name, 'mock')
+
+        def continuation():
+            self.assertEqual(v.value, 42)
+
+        self.assert_unifies(pattern, MockMock(), continuation)
+
     def test_variable_monad(self):
 
         v = Variable()
@@ -170,7 +592,7 @@ class TestPatterns(TestUnifiable):
             self.assertEqual(m.mock, w.value)
 
         self.assert_unifies(
-            Attribute('foo') ** v & Attribute('mock') ** w ** Attribute('foo') ** v,
+            ATTR_FOO ** v & Attribute('mock') ** w ** ATTR_FOO ** v,
             m, continuation)
 
     def test_pattern(self):
@@ -184,12 +606,12 @@ class TestPatterns(TestUnifiable):
         def continuation2():
             self.assertEqual(42, v2.value)
 
-        pattern1 = Attribute('bar') ** Index(1) ** v1
+        pattern1 = ATTR_BAR ** Index(1) ** v1
         self.assert_unifies(pattern1, m, continuation1)
 
         pattern2 = (pattern1
-                    & Attribute('foo') ** v2
-                    & Attribute('mock') ** Attribute('foo') ** v2)
+                    & ATTR_FOO ** v2
+                    & Attribute('mock') ** ATTR_FOO ** v2)
         self.assert_unifies(pattern2, m, continuation2)
 
     def test_pattern2(self):
@@ -215,15 +637,115 @@ class TestPatterns(TestUnifiable):
             # Will be called for each match
             print var.value
 
-        pattern1 = (Subtype(Sophisticated) ** Attribute('bar') ** Subtype(Simple) ** Attribute('foo') ** var)
-        pattern2 = pattern1 | Attribute('foo') ** var
+        pattern1 = (Subtype(Sophisticated) ** ATTR_BAR ** Subtype(Simple) ** ATTR_FOO ** var)
+        pattern2 = pattern1 | ATTR_FOO ** var
 
         self.assert_unifies(pattern2, object_under_test, matched)
 
+    def test_star_import(self):
+        namespace = {}
+        exec('from patterns import *', namespace)
+        self.assertIn('Variable', namespace)
+        for name in ('run', 'STOP', 'OP_CALL', 're', 'partial'):
+            self.assertNotIn(name, namespace)
 
 
+class TestCompiledPatterns(TestPatterns):
+    """Runs the pattern tests against the generated matchers"""
+
+    def assert_unifies(self, pattern, against, continuation=None):
+        TestPatterns.assert_unifies(self, pattern.compile(), against, continuation)
+
+    def assert_fails(self, pattern, against):
+        TestPatterns.assert_fails(self, pattern.compile(), against)
+
+    def test_compile_is_cached(self):
+        pattern = ATTR_FOO ** Variable()
+        self.assertIs(pattern.compile(), pattern.compile())
+
+    def test_compiled_source(self):
+        pattern = Constant(1) & Variable() | NONE
+        self.assertNotIn('unify', pattern.compile().source)
+
+    def test_inlined_lookups(self):
+        source = (SUB_MOCK ** ATTR_FOO ** Variable()).compile().source
+        self.assertIn('isinstance(value, ', source)
+        self.assertIn('= value.foo', source)
+        source = (Index(1) ** Index('foo') ** Variable()).compile().source
+        self.assertIn('= value[1]', source)
+
+    def test_compiled_matches(self):
+        v = Variable()
+        patterns = [(SUB_MOCK ** ATTR_FOO ** v, Mock(42), True),
+                    (SUB_MOCK ** ATTR_BAR ** v, Mock(42), False),
+                    (Each ** If(lambda x: x > 1) ** v, [1, 2, 3], True),
+                    (Each ** If(lambda x: x > 1) ** v, [1], False),
+                    (v & NONE | Index(0) ** v, [1], True),
+                    (v & NONE | Index(1) ** v, [1], False)]
+        for pattern, value, matches in patterns:
+            self.assertEqual(pattern.compile().matches(value), matches)
+            self.assertEqual(pattern.specialize().matches(value), matches)
+            self.assertFalse(v.bound)
+
+    def test_deep_pattern_is_interpreted(self):
+        pattern = Constant(42)
+        for _ in range(200):
+            pattern = pattern & Constant(42)
+        self.assertIsNone(pattern.compile().source)
+        self.assert_unifies(pattern, 42)
+
+
+class TestSpecializedPatterns(TestPatterns):
+    """Runs the pattern tests against matchers generated per type"""
+
+    def assert_unifies(self, pattern, against, continuation=None):
+        TestPatterns.assert_unifies(self, pattern.specialize(), against, continuation)
+
+    def assert_fails(self, pattern, against):
+        TestPatterns.assert_fails(self, pattern.specialize(), against)
+
+    def test_type_checks_are_decided(self):
+        pattern = (Subtype(int) | SUB_MOCK ** ATTR_FOO).specialize()
+        self.assert_unifies(pattern, Mock(42))
+        self.assert_unifies(pattern, 42)
+        self.assertNotIn('isinstance', pattern.compiled[Mock].source)
+        self.assertNotIn('isinstance', pattern.compiled[int].source)
+
+    def test_specialized_follows_registration(self):
+        Base = ABCMeta('Base', (object,), {})
+        pattern = Subtype(Base) ** ATTR_FOO
+        specialized = pattern.specialize()
+        self.assertIs(specialized, pattern.specialize())
+        self.assert_fails(specialized, Mock(42))
+        Base.register(Mock)
+        self.assert_unifies(specialized, Mock(42))
+
+
+class TestFlattenedPatterns(TestPatterns):
+    """Runs the pattern tests on the instruction loop"""
+
+    def assert_unifies(self, pattern, against, continuation=None):
+        TestPatterns.assert_unifies(self, pattern.flatten(), against, continuation)
+
+    def assert_fails(self, pattern, against):
+        TestPatterns.assert_fails(self, pattern.flatten(), against)
+
+    def test_long_chain(self):
+        pattern = Constant(42)
+        for _ in range(5000):
+            pattern = pattern & Constant(42)
+        self.assert_unifies(pattern, 42)
+        self.assert_fails(pattern & NONE, 42)
+
+    def test_deep_lookup_chain(self):
+        value = 42
+        pattern = Constant(42)
+        for _ in range(5000):
+            value = [value]
+            pattern = Index(0) ** pattern
+        self.assert_unifies(pattern, value)
+        self.assert_fails(pattern, [[[]]])
 
 
-        
 if __name__ == '__main__':
     unittest.main()